@@ -28,6 +28,20 @@ from PIL import Image
 LOWER_MAGENTA = np.array([130, 50, 100])
 UPPER_MAGENTA = np.array([175, 255, 255])
 
+# Marker detection runs on a downsampled copy of the API output, so the image
+# has a quarter of the pixels to process
+DETECTION_SCALE = 0.5
+
+# Structuring element for cleaning up the marker mask: a 5px ellipse at full
+# resolution, scaled with the detection image (3x3 at half scale) so markers
+# smaller than the requested ~15px are not erased by the opening
+MORPH_KERNEL_SIZE = 2 * round(2 * DETECTION_SCALE) + 1
+MORPH_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (MORPH_KERNEL_SIZE, MORPH_KERNEL_SIZE))
+
+# A mask that is one blob at least this large (in output-image pixels) is
+# taken as the marker without morphological cleanup
+MIN_CLEAN_MARKER_AREA = 50
+
 # Gemini model with image generation capability
 MODEL = "gemini-3-pro-image-preview"
 
@@ -81,34 +95,64 @@ def locate(image_path: str, description: str, debug: bool = False) -> dict:
     annotated_path = str(output_path.parent / f"{output_path.stem}_annotated.png")
     output_image.save(annotated_path)
 
-    # Detect marker with OpenCV
-    image_cv = cv2.cvtColor(np.array(output_image), cv2.COLOR_RGB2BGR)
-    output_height, output_width = image_cv.shape[:2]
-
-    hsv = cv2.cvtColor(image_cv, cv2.COLOR_BGR2HSV)
+    # Detect marker with OpenCV, reading PIL's RGB pixels directly
+    if output_image.mode != "RGB":
+        output_image = output_image.convert("RGB")
+    image_rgb = np.asarray(output_image)
+    output_height, output_width = image_rgb.shape[:2]
+    # Keep at least one pixel per axis so tiny images still resize, and map
+    # back with the scale actually applied
+    detect_width = max(1, round(output_width * DETECTION_SCALE))
+    detect_height = max(1, round(output_height * DETECTION_SCALE))
+    scale_x = detect_width / output_width
+    scale_y = detect_height / output_height
+    image_rgb = cv2.resize(image_rgb, (detect_width, detect_height),
+                           interpolation=cv2.INTER_AREA)
+
+    # Convert to HSV in place; the RGB pixels are not needed after thresholding
+    hsv = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2HSV, dst=image_rgb)
     mask = cv2.inRange(hsv, LOWER_MAGENTA, UPPER_MAGENTA)
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=2)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
+    # Bail out early when nothing is magenta
+    x0, y0, w, h = cv2.boundingRect(mask)
+    if w == 0:
+        if debug:
+            cv2.imwrite("/tmp/screenshot_locator_debug_mask.png", mask)
+        return {"detected": False, "error": "No marker detected", "annotated_image": annotated_path}
+
+    # Clean up and search only the region around magenta pixels, padded by
+    # more than the closing below can grow a blob
+    pad = 2 * MORPH_KERNEL.shape[0]
+    x1, y1 = x0 + w + pad, y0 + h + pad
+    x0, y0 = max(x0 - pad, 0), max(y0 - pad, 0)
+    region = mask[y0:y1, x0:x1]
+
+    # Find blobs (label 0 is the background). A single blob of marker size is
+    # already clean; otherwise run morphology to merge fragments and drop
+    # specks, then search again.
+    num_labels, _, stats, centroids = cv2.connectedComponentsWithStats(region, connectivity=8)
+    min_area = MIN_CLEAN_MARKER_AREA * scale_x * scale_y
+    if num_labels != 2 or stats[1, cv2.CC_STAT_AREA] < min_area:
+        region = cv2.morphologyEx(region, cv2.MORPH_CLOSE, MORPH_KERNEL, iterations=2)
+        region = cv2.morphologyEx(region, cv2.MORPH_OPEN, MORPH_KERNEL, iterations=1)
+        num_labels, _, stats, centroids = cv2.connectedComponentsWithStats(region, connectivity=8)
 
     if debug:
+        mask[y0:y1, x0:x1] = region
         cv2.imwrite("/tmp/screenshot_locator_debug_mask.png", mask)
 
-    # Find centroid
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if not contours:
+    # Take the centroid of the largest blob
+    if num_labels < 2:
         return {"detected": False, "error": "No marker detected", "annotated_image": annotated_path}
 
-    largest = max(contours, key=cv2.contourArea)
-    M = cv2.moments(largest)
-
-    if M["m00"] == 0:
-        return {"detected": False, "error": "Invalid marker shape", "annotated_image": annotated_path}
+    largest = int(np.argmax(stats[1:, cv2.CC_STAT_AREA])) + 1
+    cx_detect = centroids[largest][0] + x0
+    cy_detect = centroids[largest][1] + y0
 
-    # Get centroid in output image coordinates
-    cx_output = M["m10"] / M["m00"]
-    cy_output = M["m01"] / M["m00"]
+    # Get centroid in output image coordinates (mapping pixel centers back
+    # from the downsampled image)
+    cx_output = (cx_detect + 0.5) / scale_x - 0.5
+    cy_output = (cy_detect + 0.5) / scale_y - 0.5
 
     # Convert to normalized coordinates (0-1)
     norm_x = cx_output / output_width
@@ -140,7 +184,8 @@ def main():
         sys.exit(1)
 
     result = locate(args.image_path, args.description, args.debug)
-    print(json.dumps(result, indent=2))
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
     sys.exit(0 if result["detected"] else 1)
 
 
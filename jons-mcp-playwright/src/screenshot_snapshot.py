@@ -18,9 +18,10 @@ import base64
 import json
 import os
 import sys
+from io import BytesIO
 from pathlib import Path
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, UnidentifiedImageError
 
 # Default model - can be overridden via --model
 MODEL = "gemini-2.0-flash-exp"
@@ -36,6 +37,13 @@ OKABE_ITO_COLORS = [
     (204, 121, 167),  # Reddish Purple
 ]
 
+# Label text color per palette entry (black on light colors, white on dark),
+# by simple luminance check
+OKABE_ITO_TEXT_COLORS = [
+    (0, 0, 0) if 0.299 * r + 0.587 * g + 0.114 * b > 128 else (255, 255, 255)
+    for r, g, b in OKABE_ITO_COLORS
+]
+
 # Standard ARIA roles (51 roles for canvas GUI support)
 ARIA_ROLES = [
     # Interactive/Widget
@@ -53,6 +61,7 @@ ARIA_ROLES = [
     # Status
     'alert', 'status', 'tooltip',
 ]
+ARIA_ROLES_SET = frozenset(ARIA_ROLES)
 
 SYSTEM_PROMPT = """You are an accessibility tree generator. Analyze screenshots and produce structured accessibility trees that enable automation and screen reader access.
 
@@ -116,19 +125,37 @@ For a bar chart at coordinates [50, 100, 400, 600]:
 - Include all meaningful interactive elements"""
 
 
+# Generated schemas keyed by depth; nested element subschemas are shared
+_SCHEMA_CACHE = {}
+_ELEMENT_SCHEMA_CACHE = {}
+
+
 def build_schema(depth=4):
-    """Generate nested schema without $ref (Gemini constraint)."""
+    """Generate nested schema without $ref (Gemini constraint).
+
+    The result is cached and shares subschemas with other depths, so it must
+    not be mutated.
+    """
+    if depth in _SCHEMA_CACHE:
+        return _SCHEMA_CACHE[depth]
+
+    # Leaf property schemas are identical at every depth, so share them
+    role_schema = {'type': 'string', 'enum': ARIA_ROLES}
+    name_schema = {'type': 'string'}
+    bbox_schema = {
+        'type': 'array',
+        'items': {'type': 'integer'}
+    }
 
     def element(d):
+        if d in _ELEMENT_SCHEMA_CACHE:
+            return _ELEMENT_SCHEMA_CACHE[d]
         base = {
             'type': 'object',
             'properties': {
-                'role': {'type': 'string', 'enum': ARIA_ROLES},
-                'name': {'type': 'string'},
-                'bounding_box': {
-                    'type': 'array',
-                    'items': {'type': 'integer'}
-                }
+                'role': role_schema,
+                'name': name_schema,
+                'bounding_box': bbox_schema,
             },
             'required': ['role', 'name', 'bounding_box']
         }
@@ -137,9 +164,10 @@ def build_schema(depth=4):
                 'type': 'array',
                 'items': element(d - 1)
             }
+        _ELEMENT_SCHEMA_CACHE[d] = base
         return base
 
-    return {
+    _SCHEMA_CACHE[depth] = {
         'type': 'object',
         'properties': {
             'elements': {
@@ -149,37 +177,18 @@ def build_schema(depth=4):
         },
         'required': ['elements']
     }
+    return _SCHEMA_CACHE[depth]
 
 
-def assign_refs(elements, counter=None):
-    """Assign v-prefixed refs to elements (v1, v2, ...) in tree order."""
-    if counter is None:
-        counter = {'value': 1}
-
-    for el in elements:
-        el['ref'] = f"v{counter['value']}"
-        counter['value'] += 1
-        if 'children' in el:
-            assign_refs(el['children'], counter)
-
-
-def draw_annotations(image_path, elements, output_path):
-    """Draw bounding boxes and ref labels on image.
-
-    Args:
-        image_path: Path to original image
-        elements: List of elements with ref and bounding_box
-        output_path: Path to save annotated image
-    """
-    # Open image and convert to RGBA for transparency support
-    img = Image.open(image_path).convert('RGBA')
+# Label font, loaded on first use by get_font()
+_FONT = None
 
-    # Create overlay for semi-transparent fills
-    overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
-    draw_overlay = ImageDraw.Draw(overlay)
 
-    # Create draw context for borders and labels
-    draw = ImageDraw.Draw(img)
+def get_font():
+    """Load the label font once, trying common system fonts first."""
+    global _FONT
+    if _FONT is not None:
+        return _FONT
 
     # Try to load a font, fall back to default
     try:
@@ -200,17 +209,41 @@ def draw_annotations(image_path, elements, output_path):
     except Exception:
         font = ImageFont.load_default()
 
-    # Flatten elements to list with refs
-    def flatten(els, result=None):
-        if result is None:
-            result = []
-        for el in els:
-            result.append(el)
-            if 'children' in el:
-                flatten(el['children'], result)
-        return result
+    _FONT = font
+    return font
+
 
-    flat_elements = flatten(elements)
+def draw_annotations(image_path, flat_elements, output_path):
+    """Draw bounding boxes and ref labels on image.
+
+    Args:
+        image_path: Path to original image
+        flat_elements: Elements in tree order (from walk_tree) with ref and bounding_box
+        output_path: Path to save annotated image
+    """
+    # Keep opaque screenshots in RGB; only images with transparency need RGBA
+    img = Image.open(image_path)
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+
+    # Create draw context for borders and labels
+    draw = ImageDraw.Draw(img)
+
+    font = get_font()
+
+    # All labels are "v" plus digits, so they share one text height
+    label_bbox = font.getbbox('v0123456789')
+    text_height = label_bbox[3] - label_bbox[1]
+
+    # Create overlay for semi-transparent fills, covering only the region
+    # spanned by the boxes rather than the whole image
+    boxes = [el['bounding_box'] for el in flat_elements if len(el.get('bounding_box', [])) == 4]
+    overlay_x = max(0, min((b[1] for b in boxes), default=0))
+    overlay_y = max(0, min((b[0] for b in boxes), default=0))
+    overlay_width = min(img.width, max((b[3] + 1 for b in boxes), default=0)) - overlay_x
+    overlay_height = min(img.height, max((b[2] + 1 for b in boxes), default=0)) - overlay_y
+    overlay = Image.new('RGBA', (max(overlay_width, 0), max(overlay_height, 0)), (0, 0, 0, 0))
+    draw_overlay = ImageDraw.Draw(overlay)
 
     # Draw each element
     for i, el in enumerate(flat_elements):
@@ -225,17 +258,17 @@ def draw_annotations(image_path, elements, output_path):
 
         # Draw semi-transparent fill on overlay
         fill_color = (*color, 40)  # ~15% opacity
-        draw_overlay.rectangle([x_min, y_min, x_max, y_max], fill=fill_color)
+        draw_overlay.rectangle(
+            [x_min - overlay_x, y_min - overlay_y, x_max - overlay_x, y_max - overlay_y],
+            fill=fill_color
+        )
 
         # Draw solid border (2px width)
         draw.rectangle([x_min, y_min, x_max, y_max], outline=color, width=2)
 
         # Draw ref label background and text
         label = ref
-        # Get text bounding box
-        text_bbox = draw.textbbox((0, 0), label, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
+        text_width = round(font.getlength(label))
 
         # Position label at top-left of bounding box
         label_x = x_min + 2
@@ -256,13 +289,15 @@ def draw_annotations(image_path, elements, output_path):
         )
 
         # Draw label text (white for dark colors, black for light)
-        # Simple luminance check
-        luminance = 0.299 * color[0] + 0.587 * color[1] + 0.114 * color[2]
-        text_color = (0, 0, 0) if luminance > 128 else (255, 255, 255)
+        text_color = OKABE_ITO_TEXT_COLORS[i % len(OKABE_ITO_COLORS)]
         draw.text((label_x, label_y), label, fill=text_color, font=font)
 
-    # Composite overlay onto image
-    img = Image.alpha_composite(img, overlay)
+    # Composite overlay onto image in place (for an opaque image, pasting
+    # through the overlay's own alpha is the same blend)
+    if has_alpha:
+        img.alpha_composite(overlay, dest=(overlay_x, overlay_y))
+    else:
+        img.paste(overlay, (overlay_x, overlay_y), overlay)
 
     # Convert back to RGB for saving as PNG (or keep RGBA)
     img.save(output_path, 'PNG')
@@ -327,34 +362,85 @@ def add_crop_offset(el, offset_x, offset_y):
         add_crop_offset(child, offset_x, offset_y)
 
 
-def validate_element(el, width, height, errors, path="root"):
-    """Validate and clamp bounding boxes (after coordinate conversion)."""
-    bbox = el.get('bounding_box', [])
-    if len(bbox) != 4:
-        errors.append(f"{path}: invalid bounding_box length")
-        return
-
-    y_min, x_min, y_max, x_max = bbox
+def walk_tree(elements, width, height):
+    """Assign refs, then validate and clamp bounding boxes, in one pass.
 
-    # Validate ordering
-    if y_min > y_max or x_min > x_max:
-        errors.append(f"{path}: invalid bbox dimensions (y_min={y_min}, y_max={y_max}, x_min={x_min}, x_max={x_max})")
+    Runs after coordinate conversion. Elements are visited depth-first in
+    tree order and receive v-prefixed refs (v1, v2, ...). Subtrees below an
+    element with a malformed bounding_box get refs but are not validated.
 
-    # Clamp to image bounds
-    el['bounding_box'] = [
-        max(0, min(height, y_min)),
-        max(0, min(width, x_min)),
-        max(0, min(height, y_max)),
-        max(0, min(width, x_max))
-    ]
+    Returns:
+        (flat_elements, errors): every element in tree order, and validation
+        warnings
+    """
+    flat_elements = []
+    errors = []
+    ref = 1
+
+    # Walk with an explicit stack; children are pushed in reverse so elements
+    # and warnings come out in tree order. Entries carry the element's path,
+    # or None when it sits below a malformed bounding_box.
+    stack = [(el, f"elements[{i}]") for i, el in reversed(list(enumerate(elements)))]
+    while stack:
+        el, path = stack.pop()
+        el['ref'] = 'v' + str(ref)
+        ref += 1
+        flat_elements.append(el)
+
+        if path is not None:
+            bbox = el.get('bounding_box', [])
+            if len(bbox) != 4:
+                errors.append(f"{path}: invalid bounding_box length")
+                path = None
+            else:
+                y_min, x_min, y_max, x_max = bbox
+
+                # Validate ordering
+                if y_min > y_max or x_min > x_max:
+                    errors.append(f"{path}: invalid bbox dimensions (y_min={y_min}, y_max={y_max}, x_min={x_min}, x_max={x_max})")
+
+                # Clamp to image bounds
+                el['bounding_box'] = [
+                    max(0, min(height, y_min)),
+                    max(0, min(width, x_min)),
+                    max(0, min(height, y_max)),
+                    max(0, min(width, x_max))
+                ]
+
+                # Validate role
+                if el.get('role') not in ARIA_ROLES_SET:
+                    errors.append(f"{path}: invalid role '{el.get('role')}'")
+
+        children = el.get('children', [])
+        for i in range(len(children) - 1, -1, -1):
+            child_path = f"{path}.children[{i}]" if path is not None else None
+            stack.append((children[i], child_path))
+
+    return flat_elements, errors
+
+
+def detect_mime_type(image_bytes):
+    """Detect image mime type from its file signature, defaulting to PNG.
+
+    Sniffing the bytes also handles misnamed files, such as a cropped PNG
+    saved under the original screenshot's .jpeg name.
+    """
+    if image_bytes.startswith(b'\x89PNG'):
+        return 'image/png'
+    if image_bytes.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if image_bytes.startswith(b'GIF8'):
+        return 'image/gif'
+    if image_bytes.startswith(b'RIFF') and image_bytes[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/png'
 
-    # Validate role
-    if el.get('role') not in ARIA_ROLES:
-        errors.append(f"{path}: invalid role '{el.get('role')}'")
 
-    # Recurse
-    for i, child in enumerate(el.get('children', [])):
-        validate_element(child, width, height, errors, f"{path}.children[{i}]")
+def write_json(data):
+    """Stream data to stdout as one line of JSON."""
+    json.dump(data, sys.stdout)
+    sys.stdout.write("\n")
+    sys.stdout.flush()
 
 
 def main():
@@ -376,51 +462,57 @@ def main():
             crop_x, crop_y, crop_w, crop_h = map(int, args.crop.split(','))
             crop_offset = (crop_x, crop_y)
         except ValueError:
-            print(json.dumps({
+            write_json({
                 "error": f"Invalid crop format: {args.crop}. Expected x,y,width,height",
                 "error_code": "invalid_crop"
-            }))
+            })
             sys.exit(1)
 
     # Check for API key
     api_key = os.environ.get("GEMINI_API_KEY")
     if not api_key:
-        print(json.dumps({
+        write_json({
             "error": "GEMINI_API_KEY environment variable not set",
             "error_code": "auth_missing"
-        }))
+        })
         sys.exit(1)
 
     # Verify image exists
     if not Path(args.image_path).exists():
-        print(json.dumps({
+        write_json({
             "error": f"Image not found: {args.image_path}",
             "error_code": "file_not_found"
-        }))
+        })
         sys.exit(1)
 
     try:
         from google import genai
         from google.genai import types
 
-        # Load image and get dimensions
-        image = Image.open(args.image_path)
+        # Read image bytes once; PIL parses dimensions from the same buffer
+        image_bytes = Path(args.image_path).read_bytes()
+        try:
+            image = Image.open(BytesIO(image_bytes))
+        except UnidentifiedImageError as e:
+            # Report the file path rather than the in-memory buffer
+            raise UnidentifiedImageError(f"cannot identify image file {args.image_path!r}") from e
 
         # Crop image if --crop was provided
         if args.crop:
             crop_x, crop_y, crop_w, crop_h = map(int, args.crop.split(','))
             # PIL crop uses (left, upper, right, lower) format
             image = image.crop((crop_x, crop_y, crop_x + crop_w, crop_y + crop_h))
-            # Save cropped image to temp file for API and annotated output
+            # Encode cropped image for the API and save it for annotated output
+            buffer = BytesIO()
+            image.save(buffer, 'PNG')
+            image_bytes = buffer.getvalue()
+            buffer.close()
             cropped_path = Path(args.image_path).parent / f"cropped_{Path(args.image_path).name}"
-            image.save(str(cropped_path), 'PNG')
+            cropped_path.write_bytes(image_bytes)
             args.image_path = str(cropped_path)  # Update path for annotated image output
 
         width, height = image.size
-
-        # Read image bytes for API (use cropped if applicable)
-        with open(args.image_path, "rb") as f:
-            image_bytes = f.read()
+        image.close()  # Only the dimensions are needed from here on
 
         # Build user prompt
         prompt = f"""Analyze this {width}x{height} pixel screenshot and generate an accessibility tree.
@@ -440,15 +532,8 @@ Focus on elements useful for automation and data extraction."""
         # Call Gemini API with structured output
         client = genai.Client(api_key=api_key)
 
-        # Determine mime type from file extension
-        ext = Path(args.image_path).suffix.lower()
-        mime_type = {
-            '.png': 'image/png',
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.gif': 'image/gif',
-            '.webp': 'image/webp',
-        }.get(ext, 'image/png')
+        # Determine mime type from the image bytes
+        mime_type = detect_mime_type(image_bytes)
 
         response = client.models.generate_content(
             model=args.model,
@@ -468,6 +553,9 @@ Focus on elements useful for automation and data extraction."""
             )
         )
 
+        # Release the image payload before parsing and annotating
+        del image_bytes
+
         # Parse response
         tree = json.loads(response.text)
 
@@ -481,14 +569,9 @@ Focus on elements useful for automation and data extraction."""
             for el in tree.get('elements', []):
                 add_crop_offset(el, offset_x, offset_y)
 
-        # Validate and clamp bounding boxes
-        errors = []
-        for i, el in enumerate(tree.get('elements', [])):
-            validate_element(el, width, height, errors, f"elements[{i}]")
-
-        # Assign refs to elements
+        # Assign refs and validate/clamp bounding boxes in one pass
         elements = tree.get('elements', [])
-        assign_refs(elements)
+        flat_elements, errors = walk_tree(elements, width, height)
 
         # Build result
         result = {
@@ -505,17 +588,17 @@ Focus on elements useful for automation and data extraction."""
         if args.annotate:
             input_path = Path(args.image_path)
             annotated_path = input_path.parent / f"{input_path.stem}_annotated.png"
-            draw_annotations(args.image_path, elements, str(annotated_path))
+            draw_annotations(args.image_path, flat_elements, str(annotated_path))
             result["annotated_image"] = str(annotated_path)
 
-        print(json.dumps(result))
+        write_json(result)
         sys.exit(0)
 
     except json.JSONDecodeError as e:
-        print(json.dumps({
+        write_json({
             "error": f"Invalid JSON from Gemini: {e}",
             "error_code": "schema_error"
-        }))
+        })
         sys.exit(1)
 
     except Exception as e:
@@ -531,10 +614,10 @@ Focus on elements useful for automation and data extraction."""
         elif "timeout" in error_str:
             error_code = "timeout"
 
-        print(json.dumps({
+        write_json({
             "error": str(e),
             "error_code": error_code
-        }))
+        })
         sys.exit(1)
 
 